@@ -1,8 +1,11 @@
+import contextlib
+import copy
 import os
-import random
 import torch
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as functional
+from torchvision.io import decode_jpeg, read_file, ImageReadMode
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
 from sys import platform
@@ -22,6 +25,19 @@ else:
 
 VAL_SIZE = 0.1
 TRAIN_SIZE = 0.9
+SPLIT_SEED = 3710
+
+BATCH_SIZE = 32
+# CPUs this process may run on, which follows the Slurm allocation rather than every CPU on the node
+AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 2)
+NUM_WORKERS = min(8, AVAILABLE_CPUS)
+PREFETCH_FACTOR = 4
+
+IMAGE_SIZE = (256, 240)
+CACHE_ROOT = "./cache"
+# Decoder used to build the image caches, "pil" on the CPU or "nvjpeg" on a CUDA device. nvJPEG and PIL don't
+# produce identical pixels, so train and test caches must be built with the same one
+DECODE_BACKEND = "pil"
 
 
 class SiameseDataSet(Dataset):
@@ -30,15 +46,34 @@ class SiameseDataSet(Dataset):
     Reference : https://github.com/maticvl/dataHacker/blob/master/pyTorch/014_siameseNetwork.ipynb
     """
 
-    def __init__(self, imgset: datasets.ImageFolder, transform=None):
+    def __init__(self, imgset: datasets.ImageFolder, transform=None, cache_path: str = None):
         """
         initialise class
         :param imgset: torch.datasets.ImageFolder of ADNI data
         :param transform: Transform to be applied to images to turn them into torch.Tensor instances
+        :param cache_path: optional cache of already transformed images written by build_cache, read in place of
+        decoding images from imgset
         """
-        self.imgset = imgset
+        self.loader = imgset.loader
         self.transform = transform
 
+        # Keep the samples as flat NumPy arrays rather than a list of tuples, forked DataLoader workers then share
+        # them copy-on-write instead of each touching every Python object
+        self.paths = np.array([path for path, _ in imgset.samples])
+        self.classes = np.array([cls for _, cls in imgset.samples], dtype=np.int8)
+
+        # The cache is only mapped on first use, so each DataLoader worker maps the file itself rather than being sent
+        # a pickled copy of the whole array on platforms that spawn workers
+        self.cache_path = cache_path
+        self.cache_shape = (len(self.paths), 1) + IMAGE_SIZE
+        self.cache = None
+
+        # Sample indices for each class so positives and negatives can be drawn directly from the right class
+        self.by_class = {int(c): np.flatnonzero(self.classes == c) for c in np.unique(self.classes)}
+
+        # Generator for drawing positives and negatives, replaced in each DataLoader worker by seed_worker
+        self.rng = np.random.default_rng()
+
     def __getitem__(self, index: int):
         """
         overloads function such that item calls return three times, and anchor, a positive class match for the anchor,
@@ -46,31 +81,66 @@ class SiameseDataSet(Dataset):
         :param index: integer index to be used to iterate through dataset
         :return: int: class, torch.Tensor: anchor, torch.Tensor: positive anchor match, torch.Tensor: negative anchor match
         """
-        anchor_path, anchor_class = self.imgset.samples[index]
-        anchor = self.imgset.loader(anchor_path)
+        anchor_class = int(self.classes[index])
 
-        positive = None
-        negative = None
+        pos_idx = index
+        while pos_idx == index:
+            pos_idx = self.rng.choice(self.by_class[anchor_class])
+        neg_idx = self.rng.choice(self.by_class[1 - anchor_class])
 
-        while positive is None or negative is None:
-            random_path, random_class = random.choice(self.imgset.imgs)
-            if random_path == anchor_path:
-                continue
-            elif random_class == anchor_class:
-                positive = self.imgset.loader(random_path)
-            else:
-                negative = self.imgset.loader(random_path)
+        anchor = self.get_image(index)
+        positive = self.get_image(pos_idx)
+        negative = self.get_image(neg_idx)
 
+        return anchor_class, anchor, positive, negative
+
+    def get_image(self, index: int):
+        """
+        Retrieves a single transformed image, from the cache if one was given
+        :param index: index of the image in the data set
+        :return: torch.Tensor image
+        """
+        if self.cache_path is not None:
+            if self.cache is None:
+                self.cache = np.memmap(self.cache_path, dtype=np.uint8, mode="r", shape=self.cache_shape)
+            return torch.from_numpy(np.array(self.cache[index]))
+
+        image = self.loader(self.paths[index])
         if self.transform is not None:
-            anchor = self.transform(anchor)
-            positive = self.transform(positive)
-            negative = self.transform(negative)
+            image = self.transform(image)
+        return image
 
-        return anchor_class, anchor, positive, negative
+    def __getstate__(self):
+        # Never pickle a mapped cache, workers map it again from cache_path
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
 
     def __len__(self):
         # return n_samples
-        return len(self.imgset.imgs)
+        return len(self.paths)
+
+
+def seed_worker(worker_id: int):
+    """
+    DataLoader worker_init_fn giving each worker's SiameseDataSet its own generator, seeded from the worker seed torch
+    derives for it, so workers don't draw identical triplets
+    :param worker_id: id of the DataLoader worker being initialised
+    """
+    info = torch.utils.data.get_worker_info()
+    info.dataset.rng = np.random.default_rng(info.seed)
+
+
+def triplet_collate(batch: []) -> (torch.Tensor, torch.Tensor):
+    """
+    DataLoader collate_fn stacking a batch of SiameseDataSet triplets into a single tensor, so the batch is pinned and
+    sent to the GPU in one copy rather than three
+    :param batch: list of (class, anchor, positive, negative) items from SiameseDataSet
+    :return: torch.Tensor: class labels, torch.Tensor: images of shape (3B, 1, 256, 240) holding all the anchors, then
+    all the positives, then all the negatives
+    """
+    labels, anchors, positives, negatives = zip(*batch)
+    return torch.tensor(labels), torch.stack(anchors + positives + negatives)
 
 
 def get_patients(path: str) -> [str]:
@@ -79,104 +149,319 @@ def get_patients(path: str) -> [str]:
     :param path: path to patient images
     :return: list of unique patient id's found in folder
     """
-    uids = []
-    dire = os.fsdecode(path)
-    for file in os.listdir(dire):
-        filename = os.fsdecode(file)
-        substrings = filename.split("_", 2)
-        if substrings[0] not in uids:
-            uids.append(substrings[0])
+    uids = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            uids.add(entry.name.split("_", 1)[0])
 
-    # print(f"{path} : {len(uids)}")
-    return uids
+    return sorted(uids)
 
 
-def remove_patients(imgset: datasets.ImageFolder, index: int, match_set: []) -> datasets.ImageFolder:
+def remove_patients(imgset: datasets.ImageFolder, remove: np.ndarray) -> datasets.ImageFolder:
     """
-    Removes specified pateints in match_set in order to provide a patient level split
+    Removes the images flagged in remove in order to provide a patient level split. imgset.samples is rebuilt rather
+    than modified in place, so ImageFolder's sharing a sample list can be filtered independently
     :param imgset: datasets.ImageFolder of loaded ADNI data
-    :param index: Class of ADNI photos to search for patients in. 0 = AD, 1 = NC
-    :param match_set: list of patients to remove from imgset
-    :return: datasets.Imagefolder without images featuring the specified patients match_set
-    """
-    folder = ""
-    if index == 0:
-        folder = "AD"
-    else:
-        folder = "NC"
-
-    for patient in match_set:
-        for fname in os.listdir(TRAIN_FILE_ROOT + "/" + folder):
-            if patient in fname:
-                name = TRAIN_FILE_ROOT + "\\" + folder + "\\" + fname
-                if platform == "linux" or platform == "linux2":
-                    name = TRAIN_FILE_ROOT + "/" + folder + "/" + fname
-                imgset.imgs.remove((name, index))
+    :param remove: boolean mask over imgset.samples, True for images of patients to remove
+    :return: datasets.Imagefolder without the flagged images
+    """
+    keep = [imgset.samples[i] for i in np.flatnonzero(~remove)]
+    imgset.samples = keep
+    imgset.imgs = keep
+    imgset.targets = [cls for _, cls in keep]
 
     return imgset
 
 
-def get_patient_split() -> (datasets.ImageFolder, datasets.ImageFolder):
+def get_patient_split(seed: int = SPLIT_SEED) -> (datasets.ImageFolder, datasets.ImageFolder):
     """
     Loads ADNI training set data, retrieves all patients present in the AD and NC classes and performs a patient-level
     split on data to prevent data leakage during training between train and validation sets.
+    :param seed: seed for shuffling patients, the same seed always gives the same split
     :return: train and validation ImageFolder's
     """
-    files = get_patients(TRAIN_FILE_ROOT + "/AD")
-    random.shuffle(files)
-    train_ad, validate_ad = np.split(files, [int(len(files) * TRAIN_SIZE)])
-    files = get_patients(TRAIN_FILE_ROOT + "/NC")
-    random.shuffle(files)
-    train_nc, validate_nc = np.split(files, [int(len(files) * TRAIN_SIZE)])
-
+    rng = np.random.default_rng(seed)
+    ad = np.array(get_patients(os.path.join(TRAIN_FILE_ROOT, "AD")))
+    nc = np.array(get_patients(os.path.join(TRAIN_FILE_ROOT, "NC")))
+    rng.shuffle(ad)
+    rng.shuffle(nc)
+    validate_ad = ad[int(len(ad) * TRAIN_SIZE):]
+    validate_nc = nc[int(len(nc) * TRAIN_SIZE):]
+
+    # Walk the train folder once, both splits are filtered from the same sample list
     train_dataset = datasets.ImageFolder(root=TRAIN_FILE_ROOT)
-    validation_dataset = datasets.ImageFolder(root=TRAIN_FILE_ROOT)
+    validation_dataset = copy.copy(train_dataset)
 
-    train_dataset = remove_patients(train_dataset, 0, validate_ad)
-    train_dataset = remove_patients(train_dataset, 1, validate_nc)
+    # Parse the class and patient id of every image once, then flag validation patients in a single vector pass
+    samples = train_dataset.samples
+    classes = np.fromiter((cls for _, cls in samples), dtype=np.int8, count=len(samples))
+    prefixes = np.array([os.path.basename(path).split("_", 1)[0] for path, _ in samples])
+    validate = ((classes == 0) & np.isin(prefixes, validate_ad)) | ((classes == 1) & np.isin(prefixes, validate_nc))
 
-    validation_dataset = remove_patients(validation_dataset, 0, train_ad)
-    validation_dataset = remove_patients(validation_dataset, 1, train_nc)
+    train_dataset = remove_patients(train_dataset, validate)
+    validation_dataset = remove_patients(validation_dataset, ~validate)
 
     return train_dataset, validation_dataset
 
 
-def get_test_set() -> DataLoader:
+def get_test_set(device=None) -> DataLoader:
     """
-    Loads test set as an isntance of the SiameseDataSet class
+    Loads test set as an isntance of the SiameseDataSet class, decoded images are cached in CACHE_ROOT. Batches are
+    collated into pinned memory, so consumers should iterate over them with Prefetcher to overlap the copy to the GPU
+    with compute
+    :param device: gpu device to decode JPEGs on while building the cache if DECODE_BACKEND is "nvjpeg"
     :return:
     """
-    return DataLoader(SiameseDataSet(datasets.ImageFolder(root=TEST_FILE_ROOT), compose_transform()),
+    test = datasets.ImageFolder(root=TEST_FILE_ROOT)
+    transform = compose_transform()
+    cache = build_cache(test, os.path.join(CACHE_ROOT, "adni_test.u8"), transform, device)
+
+    return DataLoader(SiameseDataSet(test, transform, cache),
                       shuffle=True,
-                      num_workers=2,
-                      batch_size=32)
+                      num_workers=NUM_WORKERS,
+                      prefetch_factor=PREFETCH_FACTOR,
+                      worker_init_fn=seed_worker,
+                      collate_fn=triplet_collate,
+                      batch_size=BATCH_SIZE,
+                      pin_memory=True,
+                      persistent_workers=True)
 
 
 def compose_transform():
     """
-    Compose transform converting image to greyscale, 256x240 sized torch.Tenshor
+    Compose transform converting image to greyscale, 256x240 sized uint8 torch.Tensor. Resizing is done on the uint8
+    PIL image and the tensor is left as uint8 to cut the host to device copy, use to_device to convert it to float.
+    Decoding and resizing run on the CPU through PIL and dominate data loading, installing pillow-simd in place of
+    pillow (pip uninstall pillow && pip install pillow-simd, built against libjpeg-turbo) speeds both up with no
+    code changes
     :return: series of torchvision.transforms
     """
     return transforms.Compose([
         transforms.Grayscale(num_output_channels=1),
-        transforms.Resize((256, 240)),
-        transforms.ToTensor()
+        transforms.Resize(IMAGE_SIZE),
+        transforms.PILToTensor()
     ])
 
 
-def load() -> (SiameseDataSet, SiameseDataSet):
+class CacheDataSet(Dataset):
+    """
+    Class for decoding every image of an ImageFolder once in DataLoader workers while build_cache fills the cache
+    """
+
+    def __init__(self, imgset: datasets.ImageFolder, transform, gpu_jpeg: bool = False):
+        """
+        initialise class
+        :param imgset: datasets.ImageFolder of ADNI data
+        :param transform: compose_transform series of torchvision.transforms producing uint8 tensors
+        :param gpu_jpeg: return JPEGs still encoded so they can be decoded on the GPU by the main process
+        """
+        self.loader = imgset.loader
+        self.transform = transform
+        self.gpu_jpeg = gpu_jpeg
+        self.paths = np.array([path for path, _ in imgset.samples])
+
+    def __getitem__(self, index: int):
+        """
+        Decodes a single image, or reads its raw bytes if it is a JPEG to be decoded on the GPU
+        :param index: index of the image in imgset.samples
+        :return: int: index, torch.Tensor: image or raw file bytes, bool: True if the image is still encoded
+        """
+        path = self.paths[index]
+        if self.gpu_jpeg and path.lower().endswith((".jpg", ".jpeg")):
+            return index, read_file(path), True
+
+        return index, self.transform(self.loader(path)), False
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def decode_on_gpu(data: [torch.Tensor], device) -> torch.Tensor:
+    """
+    Decodes a batch of JPEGs into greyscale, 256x240 sized uint8 torch.Tensor's on the GPU with nvJPEG, copying the
+    batch back to the CPU once rather than once per image. Images are decoded one call at a time as decode_jpeg only
+    accepts lists from torchvision 0.19
+    :param data: list of raw JPEG file bytes
+    :param device: gpu device to decode on
+    :return: uint8 torch.Tensor of shape (len(data), 1, 256, 240) on the CPU
+    """
+    images = [decode_jpeg(jpeg, mode=ImageReadMode.GRAY, device=device) for jpeg in data]
+    return torch.stack([functional.resize(image, list(IMAGE_SIZE), antialias=True) for image in images]).cpu()
+
+
+def cache_is_valid(cache_path: str, paths: np.ndarray, shape: tuple, backend: str) -> bool:
+    """
+    Checks an existing cache was built from the same images, with the same image shape, dtype and decode backend
+    :param cache_path: file the decoded images are stored in
+    :param paths: paths of the images the cache should hold, in order
+    :param shape: shape the cache should have
+    :param backend: "nvjpeg" or "pil", the decoder the cache should have been built with
+    :return: True if the cache can be reused
+    """
+    index_file = cache_path + ".index.npz"
+    if not (os.path.exists(cache_path) and os.path.exists(index_file)):
+        return False
+    if os.path.getsize(cache_path) != int(np.prod(shape)) * np.dtype(np.uint8).itemsize:
+        return False
+
+    with np.load(index_file) as index:
+        return (tuple(index["shape"]) == shape and str(index["dtype"]) == np.dtype(np.uint8).str
+                and "backend" in index and str(index["backend"]) == backend
+                and np.array_equal(index["paths"], paths))
+
+
+def build_cache(imgset: datasets.ImageFolder, cache_path: str, transform, device=None) -> str:
+    """
+    Decodes and transforms every image in imgset once into a uint8 memory-mapped file, so later epochs skip PIL
+    entirely and DataLoader workers share the same pages. Images are decoded across NUM_WORKERS DataLoader workers
+    and written into the cache by the main process. The image paths, shape, dtype and decode backend are saved
+    alongside the cache and an existing cache is only reused if they all match, nvJPEG and PIL don't produce
+    identical pixels so caches built with either are never mixed up
+    :param imgset: datasets.ImageFolder of ADNI data
+    :param cache_path: file to store the decoded images in
+    :param transform: compose_transform series of torchvision.transforms producing uint8 tensors
+    :param device: gpu device to decode JPEGs on if DECODE_BACKEND is "nvjpeg"
+    :return: cache_path, holding uint8 images of shape (N, 1, 256, 240) in the order of imgset.samples
+    """
+    paths = np.array([path for path, _ in imgset.samples])
+    shape = (len(paths), 1) + IMAGE_SIZE
+    backend = DECODE_BACKEND
+    gpu_jpeg = backend == "nvjpeg"
+    if gpu_jpeg and (device is None or torch.device(device).type != "cuda"):
+        raise ValueError(f"DECODE_BACKEND \"nvjpeg\" needs a CUDA device, got {device}")
+
+    if not cache_is_valid(cache_path, paths, shape, backend):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Drop the old index first, an interrupted rebuild must never leave a half written cache that looks valid
+        index_file = cache_path + ".index.npz"
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        decoder = DataLoader(CacheDataSet(imgset, transform, gpu_jpeg), batch_size=BATCH_SIZE,
+                             num_workers=NUM_WORKERS, prefetch_factor=PREFETCH_FACTOR, collate_fn=list)
+
+        cache = np.memmap(cache_path, dtype=np.uint8, mode="w+", shape=shape)
+        for batch in decoder:
+            encoded = [(index, image) for index, image, is_encoded in batch if is_encoded]
+            if encoded:
+                indices, data = zip(*encoded)
+                cache[list(indices)] = decode_on_gpu(list(data), device).numpy()
+            for index, image, is_encoded in batch:
+                if not is_encoded:
+                    cache[index] = image.numpy()
+        cache.flush()
+        del cache
+        # Only publish the index once every image is on disk
+        with open(index_file + ".tmp", "wb") as index_out:
+            np.savez(index_out, paths=paths, shape=np.array(shape), dtype=np.dtype(np.uint8).str, backend=backend)
+        os.replace(index_file + ".tmp", index_file)
+
+    return cache_path
+
+
+def to_device(tensor: torch.Tensor, device) -> torch.Tensor:
+    """
+    Sends a uint8 image batch to device and scales it to a float tensor in [0, 1] there. The batch is laid out
+    channels_last to match the SiameseNetwork weights so convolutions run without reformatting
+    :param tensor: uint8 torch.Tensor batch produced by compose_transform
+    :param device: gpu device
+    :return: float torch.Tensor on device
+    """
+    tensor = tensor.to(device, non_blocking=True).float().div_(255.)
+    return tensor.contiguous(memory_format=torch.channels_last)
+
+
+class Prefetcher:
+    """
+    Iterates over a DataLoader of triplet_collate batches while sending the next batch to the GPU on a separate CUDA
+    stream, overlapping the host to device copy with computation on the current batch
+    Reference : https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
     """
-    Loads patient-level split training and validation image sets into an instance of SiameseDataSet
+
+    def __init__(self, loader: DataLoader, device, anchors_only: bool = False):
+        """
+        initialise class
+        :param loader: DataLoader of SiameseDataSet batches
+        :param device: gpu device, batches are sent synchronously if it is not a CUDA device
+        :param anchors_only: only send the anchors to the GPU, for loops that don't use the positives and negatives
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.anchors_only = anchors_only
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.iterator = None
+        self.batch = None
+
+    def preload(self):
+        """
+        Fetch the next batch from the DataLoader and start sending it to the GPU
+        """
+        try:
+            label, images = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            self.batch = [label.to(self.device, non_blocking=True)]
+            if self.anchors_only:
+                # The anchors are the first B images of the batch, the rest never leave the host
+                self.batch.append(to_device(images[:len(label)], self.device))
+            else:
+                # Anchors, positives and negatives are sent in one copy and kept together for a single forward pass
+                self.batch.append(to_device(images, self.device))
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        """
+        Waits for the preloaded batch to reach the GPU, then starts preloading the following batch
+        :return: [label, triplets] on device with triplets as collated by triplet_collate, or [label, anchor] if
+        anchors_only is set
+        """
+        if self.batch is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for tensor in self.batch:
+                # Stop the caching allocator reusing this memory while the compute stream still needs it
+                tensor.record_stream(current)
+
+        batch = self.batch
+        self.preload()
+        return batch
+
+    def __len__(self):
+        return len(self.loader)
+
+
+def load(device=None) -> (SiameseDataSet, SiameseDataSet):
+    """
+    Loads patient-level split training and validation image sets into an instance of SiameseDataSet, decoded images
+    are cached in CACHE_ROOT. Batches are collated into pinned memory, so consumers should iterate over them with
+    Prefetcher. Workers persist across epochs so the image sets are only copied into each worker once
+    :param device: gpu device to decode JPEGs on while building the caches if DECODE_BACKEND is "nvjpeg"
     :return: training and validation SiaemseDataSet's
     """
     trainer, val = get_patient_split()
     transform = compose_transform()
 
-    trainSet = SiameseDataSet(trainer, transform)
-    valSet = SiameseDataSet(val, transform)
+    trainCache = build_cache(trainer, os.path.join(CACHE_ROOT, "adni_train.u8"), transform, device)
+    valCache = build_cache(val, os.path.join(CACHE_ROOT, "adni_validation.u8"), transform, device)
+
+    trainSet = SiameseDataSet(trainer, transform, trainCache)
+    valSet = SiameseDataSet(val, transform, valCache)
 
-    trainDataLoader = DataLoader(trainSet, shuffle=True, num_workers=2, batch_size=32)
-    valDataLoader = DataLoader(valSet, shuffle=True, num_workers=2, batch_size=32)
+    trainDataLoader = DataLoader(trainSet, shuffle=True, num_workers=NUM_WORKERS, prefetch_factor=PREFETCH_FACTOR,
+                                 worker_init_fn=seed_worker, collate_fn=triplet_collate, batch_size=BATCH_SIZE,
+                                 pin_memory=True, persistent_workers=True)
+    valDataLoader = DataLoader(valSet, shuffle=True, num_workers=NUM_WORKERS, prefetch_factor=PREFETCH_FACTOR,
+                               worker_init_fn=seed_worker, collate_fn=triplet_collate, batch_size=BATCH_SIZE,
+                               pin_memory=True, persistent_workers=True)
 
     return trainDataLoader, valDataLoader
 
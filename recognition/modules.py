@@ -45,24 +45,20 @@ class SiameseNetwork(nn.Module):
         # It's output is used to determine the similiarity
         # REDO
         cnn_output = self.cnn1(tensor)
-        cnn_output = cnn_output.view(cnn_output.size()[0], -1)
+        cnn_output = cnn_output.reshape(cnn_output.size()[0], -1)
         cnn_output = self.fc1(cnn_output)
         return cnn_output
 
-    def forward(self, anchor, positive, negative):
+    def forward(self, triplets):
         """
         Calls forward on all three images in CNN
-        :param anchor: torch.Tensor
-        :param positive: torch.Tensor
-        :param negative: torch.Tensor
+        :param triplets: torch.Tensor of shape (3B, 1, 256, 240) holding the anchors, then the positives, then the
+        negatives, as collated by triplet_collate
         :return:
         """
         # In this function we pass in  triplet images and obtain triplet vectors
-        # which are returned
-        # REDO
-        anchor_vec = self.forward_once(anchor)
-        positive_vec = self.forward_once(positive)
-        negative_vec = self.forward_once(negative)
+        # which are returned. The triplet is run through the CNN as one batch
+        anchor_vec, positive_vec, negative_vec = self.forward_once(triplets).chunk(3, dim=0)
 
         return anchor_vec, positive_vec, negative_vec
 
@@ -3,7 +3,7 @@ from torch.utils.data import DataLoader
 from os.path import exists
 from train import BINARY_MODEL_PATH, SIAMESE_MODEL_PATH
 import torch
-from dataset import get_test_set
+from dataset import get_test_set, Prefetcher
 import numpy
 
 """
@@ -31,7 +31,7 @@ def load():
 
     siamese_net = SiameseNetwork()
     siamese_net.load_state_dict(torch.load(SIAMESE_MODEL_PATH))
-    siamese_net.to(gpu)
+    siamese_net.to(gpu, memory_format=torch.channels_last)
 
     return bin_net, siamese_net, gpu
 
@@ -50,9 +50,9 @@ def predict(model: BinaryClassifier, net: SiameseNetwork, testDataLoader: DataLo
 
     acc = []
 
-    for i, (anchor_class, anchor, _, _) in enumerate(testDataLoader, 0):
-        # Send items to GPU
-        anchor, label = anchor.to(device), torch.unsqueeze(anchor_class.to(device), dim=1).float()
+    # Items are sent to the GPU by the prefetcher
+    for i, (anchor_class, anchor) in enumerate(Prefetcher(testDataLoader, device, anchors_only=True), 0):
+        label = torch.unsqueeze(anchor_class, dim=1).float()
 
         # Get siamese embeddings for the input anchor image
         siamese_embeddings = net.forward_once(anchor)
@@ -69,11 +69,11 @@ def predict(model: BinaryClassifier, net: SiameseNetwork, testDataLoader: DataLo
 
 
 def main():
-    test = get_test_set()
     vals = load()
     if vals is None:
         return
     binnn, sin, device = vals
+    test = get_test_set(device)
     predict(binnn, sin, test, device)
 
 
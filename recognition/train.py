@@ -4,7 +4,7 @@ from torch import optim
 from torch.nn import TripletMarginLoss
 import torch
 from utils import save_plot
-from dataset import load
+from dataset import load, Prefetcher
 from os.path import exists
 import torch.nn as nn
 
@@ -35,15 +35,13 @@ def iterate_batch(title: str, dataLoader: DataLoader, criterion: TripletMarginLo
     :return: counter [] containing total batches run thus far, loss [] tracking contrastive loss per batch
     """
     # Iterate over batch
-    for i, (label, anchor, positive, negative) in enumerate(dataLoader, 0):
-        # Send data to GPU
-        anchor, positive, negative = anchor.to(device), positive.to(device), negative.to(device)
-
+    # Data is sent to the GPU by the prefetcher while the previous batch is being used
+    for i, (label, triplets) in enumerate(Prefetcher(dataLoader, device), 0):
         # Zero gradients
         opt.zero_grad()
 
         # Pass in anchor, positive, and negative into network
-        anchor_vec, positive_vec, negative_vec = model(anchor, positive, negative)
+        anchor_vec, positive_vec, negative_vec = model(triplets)
 
         # Pass vectors and label to the loss function
         loss_contrastive = criterion(anchor_vec, positive_vec, negative_vec)
@@ -137,9 +135,8 @@ def train_binary(model: BinaryClassifier, siamese: SiameseNetwork, criterion: nn
 
         # Iterate over training batches
         model.train()
-        for i, (label, anchor, _, _) in enumerate(trainDataLoader, 0):
-            # Send data to GPU
-            anchor, label = anchor.to(device), torch.unsqueeze(label.to(device), dim=1).float() # label.to(device)
+        for i, (label, anchor) in enumerate(Prefetcher(trainDataLoader, device, anchors_only=True), 0):
+            label = torch.unsqueeze(label, dim=1).float()
 
             # Zero gradients
             optimiser.zero_grad()
@@ -168,9 +165,8 @@ def train_binary(model: BinaryClassifier, siamese: SiameseNetwork, criterion: nn
         print(f"Epoch {epoch}, average binary training loss = {sum(loss_ep_tracker) / len(loss_ep_tracker)}")
 
         model.eval()
-        for i, (label, anchor, _, _) in enumerate(validDataLoader, 0):
-            # Send data to GPU
-            anchor, label = anchor.to(device), torch.unsqueeze(label.to(device), dim=1).float()
+        for i, (label, anchor) in enumerate(Prefetcher(validDataLoader, device, anchors_only=True), 0):
+            label = torch.unsqueeze(label, dim=1).float()
 
             # Zero gradients
             optimiser.zero_grad()
@@ -221,14 +217,14 @@ def parent_train_binary(device, train: DataLoader, val: DataLoader):
     if not siamese_exists:
         print("No SiameseNet trained model found, training new SiameseNet")
         # Send model to gpu
-        net = SiameseNetwork().to(device)
+        net = SiameseNetwork().to(device, memory_format=torch.channels_last)
         train_siamese(net, TripletMarginLoss(), train, val, EPOCHS, device)
     else:
         print("Trained SiameseNet found, loading now...")
 
     siamese_net = SiameseNetwork()
     siamese_net.load_state_dict(torch.load(SIAMESE_MODEL_PATH))
-    siamese_net.to(device)
+    siamese_net.to(device, memory_format=torch.channels_last)
 
     crit = nn.BCELoss()
     train_binary(net, siamese_net, crit, train, val, EPOCHS, device)
@@ -239,12 +235,12 @@ def main():
     Main function to load in ADNI data, configure gpu or cpu devices, and train SiameseNet and BianryClassifier with.
     :return:
     """
-    trainData, valData = load()
-    print(f"Data loaded")
-
     # Device configuration
     gpu = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+    trainData, valData = load(gpu)
+    print(f"Data loaded")
+
     # Train binary classifier based on siamese classifier
     parent_train_binary(gpu, trainData, valData)
 
@@ -1,7 +1,8 @@
 import os
 import random
+import sys
 import matplotlib.pyplot as plt
-import datetime
+import numpy as np
 
 """
 utils.py
@@ -22,10 +23,28 @@ def show_plot(iteration, loss):
 
 def save_plot(iteration: [], loss: [], name: str):
     """
-    Saves loss plot to ./assets
+    Saves loss plot to ./assets, along with the raw iteration and loss values as a compressed ./assets/{name}.npz
     :param iteration: number of batches
     :param loss: loss for each batch
     :param name: Name of batch set being tested
     """
     plt.plot(iteration, loss)
     plt.savefig(f"./assets/{name}.png")
+    np.savez_compressed(f"./assets/{name}.npz", it=np.asarray(iteration, dtype=np.int32),
+                        loss=np.asarray(loss, dtype=np.float32))
+
+
+def load_log(name: str) -> (np.ndarray, np.ndarray):
+    """
+    Loads iteration and loss values saved by save_plot
+    :param name: Name of batch set the log was saved under
+    :return: np.ndarray of batch numbers, np.ndarray of loss for each batch
+    """
+    with np.load(f"./assets/{name}.npz") as log:
+        return log["it"], log["loss"]
+
+
+if __name__ == "__main__":
+    # Show saved loss plots, e.g. python utils.py siamese_train siamese_validation
+    for log_name in sys.argv[1:]:
+        show_plot(*load_log(log_name))